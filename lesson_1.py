@@ -1,118 +1,308 @@
 #!/usr/bin/env python3
-import subprocess
 import re
 import os
+import mmap
+import hashlib
+import shelve
+import asyncio
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from typing import List
+from pydantic import BaseModel, Field
+from botocore.config import Config
 from strands import Agent
 from strands.models import BedrockModel
 
-def list_files(repo_path):
-    """Step 1: List all files in repository"""
-    result = subprocess.run(['find', repo_path, '-type', 'f', '-name', '*.java'], 
-                          capture_output=True, text=True)
-    return result.stdout.strip().split('\n') if result.stdout else []
-
-def find_test_lines(file_path):
-    """Step 2: Find lines containing 'test'"""
-    result = subprocess.run(['grep', '-n', '-i', 'test', file_path], 
-                          capture_output=True, text=True)
-    return result.stdout.strip().split('\n') if result.stdout else []
-
-def extract_test_methods(test_lines):
-    """Step 3: Extract actual test methods/functions"""
-    test_methods = []
-    for line in test_lines:
-        # Match Java test methods with @Test annotation or test_ prefix
-        if re.search(r'(public|private|protected).*test\w+\s*\(', line, re.IGNORECASE) or '@Test' in line:
-            test_methods.append(line)
-    return test_methods
-
-def analyze_test_with_agent(method_line, file_path, agent):
-    """Step 4: AGENT TASK - identify what test is doing"""
-    if ':' not in method_line:
-        return "Unknown test"
-    
-    parts = method_line.split(':', 1)
-    if len(parts) < 2:
-        return "Unknown test"
-        
-    line_num = parts[0]
-    method_content = parts[1]
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None  # Optional, test method lines are then matched with re
+
+# Bedrock calls are network-bound, so batches are analyzed concurrently
+MAX_CONCURRENT_REQUESTS = 32
+
+# Step 4 runs on Nova Micro first and only escalates to Nova Lite when its answer is unusable
+FAST_MODEL_ID = "amazon.nova-micro-v1:0"
+FALLBACK_MODEL_ID = "amazon.nova-lite-v1:0"
+GENERIC_PURPOSES = ('tests something', 'tests the method')
+
+# Bedrock models (and their boto3 clients) shared by all agents, built once per process
+_bedrock_models = {}
+
+# Purposes of already analyzed test bodies, keyed by normalized-body fingerprint
+CACHE_PATH = os.path.expanduser("~/.cache/test_extract.db")
+
+# Methods of several files share one agent call, up to about this many prompt tokens or methods
+MAX_BATCH_TOKENS = 6000
+MAX_BATCH_METHODS = 16
+
+_COMMENT_RE = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Lines with a Java test method signature or a @Test annotation, matched in-process on the raw bytes
+_TEST_METHOD_RE = re.compile(
+    rb'^(?:[^\n]*@Test[^\n]*|[^\n]*(?i:(?:public|private|protected)[^\n]*test\w+[^\S\n]*\()[^\n]*)$',
+    re.MULTILINE
+)
+
+def _compile_test_method_db():
+    """Compile the patterns of _TEST_METHOD_RE into a Hyperscan database"""
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[rb'@Test', rb'(?:public|private|protected)[^\n]*test\w+[^\S\n]*\('],
+        ids=[0, 1],
+        flags=[0, hyperscan.HS_FLAG_CASELESS]
+    )
+    return db
+
+# Hyperscan scans for both patterns at once without backtracking; only used from the main thread
+_TEST_METHOD_DB = _compile_test_method_db() if hyperscan else None
+
+class TestPurposeById(BaseModel):
+    """Model representing the purpose of one test method of a batch"""
+    id: int = Field(description="Id of the test method, as given in the prompt")
+    purpose: str = Field(description="What the test method tests, starting with 'Tests'")
+
+class BatchedPurposes(BaseModel):
+    """Model representing the purposes of a batch of test methods from one or more files"""
+    items: List[TestPurposeById] = Field(description="One entry per test method of the batch")
+
+@dataclass(slots=True)
+class TestLine:
+    """A test method line found in steps 2-3"""
+    content: str
+    offset: int  # Byte offset of the line, so the body can be read without loading the whole file
+
+@dataclass(slots=True)
+class FileCtx:
+    """A Java file mapped once and shared by the method scan and body extraction"""
+    path: str
+    mm: mmap.mmap
+
+def iter_files(repo_path):
+    """Step 1: List all files in repository, yielding them as the walk finds them"""
+    # Walk the tree in-process instead of forking `find`
+    stack = [repo_path]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith('.java') and entry.is_file(follow_symlinks=False):
+                        yield entry.path
+        except OSError:
+            # Unreadable directories are skipped, like `find` does
+            continue
+
+def iter_test_method_lines(mm):
+    """Yield (start offset, line) for every test method line of a mapped file"""
+    if _TEST_METHOD_DB is None:
+        for match in _TEST_METHOD_RE.finditer(mm):
+            yield match.start(), match.group()
+        return
     
-    try:
-        line_num = int(line_num)
-    except ValueError:
-        return "Unknown test"
+    # Hyperscan reports match end offsets; matches ending on the same line are reported once
+    match_ends = []
+    _TEST_METHOD_DB.scan(mm, match_event_handler=lambda id, start, end, flags, context: match_ends.append(end))
+    line_end = -1
+    for end in sorted(match_ends):
+        if end <= line_end:
+            continue
+        line_start = mm.rfind(b'\n', 0, end) + 1
+        line_end = mm.find(b'\n', end)
+        if line_end < 0:
+            line_end = len(mm)
+        yield line_start, mm[line_start:line_end]
+
+def is_test_file(ctx):
+    """Cheap check whether a file can contain tests, so most sources skip the step 3 scan"""
+    return (ctx.path.endswith(('Test.java', 'Tests.java', 'IT.java'))
+            or '/test/' in ctx.path or '/tests/' in ctx.path
+            or ctx.mm.find(b'@Test') != -1 or ctx.mm.find(b'TestCase') != -1)
+
+def find_test_methods(ctx):
+    """Steps 2-3: Find test method lines in a single pass over the file"""
+    if not is_test_file(ctx):
+        return []
     
-    # Extract method body
-    try:
-        with open(file_path, 'r') as f:
-            lines = f.readlines()
-            start_line = line_num - 1
-            method_body = ''.join(lines[start_line:start_line+20])
-    except (IOError, IndexError):
-        method_body = method_content
+    return [TestLine(line.decode('utf-8', 'replace'), start) for start, line in iter_test_method_lines(ctx.mm)]
+
+def extract_method_body(ctx, test_line, num_lines=20):
+    """Read num_lines lines of code starting at a test method line"""
+    end = test_line.offset
+    for _ in range(num_lines):
+        end = ctx.mm.find(b'\n', end) + 1
+        if not end:
+            end = len(ctx.mm)
+            break
+    return ctx.mm[test_line.offset:end].decode('utf-8', 'replace')
+
+def render_method(uid, method_body):
+    """Render one method as a prompt entry keyed by its id"""
+    return f"[id={uid}] Code:\n{method_body}"
+
+def render_prompt(batch):
+    """Render a batch of (uid, method_body) tuples into a single prompt keyed by their ids"""
+    rendered = "\n".join(render_method(*method) for method in batch)
     
-    # Use agent to analyze test purpose
-    prompt = f"""
-    Analyze this Java test method and describe what it's testing in one concise sentence:
+    # Use agent to analyze all test purposes of the batch at once
+    return f"""
+    Analyze these {len(batch)} Java test methods and describe what each one is testing in one concise sentence:
     
-    Code:
-    {method_body}
+    {rendered}
     
-    Respond with format: "Tests [specific functionality]"
+    Respond with one entry per method with its id, each with format: "Tests [specific functionality]"
     """
+
+async def analyze_test_with_agent(batch, semaphore):
+    """Step 4: AGENT TASK - identify what each test of a batch is doing with a single call"""
+    # Returns the purposes by id and whether they came from the model
+    async with semaphore:
+        try:
+            return await request_purposes(batch), True
+        except Exception as e:
+            return {uid: f"Analysis failed: {str(e)}" for uid, _ in batch}, False
+
+async def analyze_batches(batches):
+    """Run step 4 on all batches concurrently, with at most MAX_CONCURRENT_REQUESTS calls in flight"""
+    # Strands still runs each blocking boto3 call via asyncio.to_thread, so every request in flight
+    # holds an executor thread; the default executor is too small to reach the limit
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS))
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return await asyncio.gather(*(analyze_test_with_agent(batch, semaphore) for batch in batches))
+
+def body_fingerprint(method_body):
+    """SHA-256 of a method body with comments and whitespace normalized away"""
+    normalized = _WHITESPACE_RE.sub(' ', _COMMENT_RE.sub('', method_body)).strip()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def get_bedrock_model(model_id):
+    """Return the process-wide Bedrock model for model_id, creating it on first use"""
+    if model_id not in _bedrock_models:
+        # Initialize Bedrock model using default credentials
+        _bedrock_models[model_id] = BedrockModel(
+            model_id=model_id,
+            region_name="us-east-1",
+            boto_client_config=Config(
+                max_pool_connections=MAX_CONCURRENT_REQUESTS,  # One connection per request in flight
+                retries={'mode': 'adaptive'}
+            )
+        )
+    return _bedrock_models[model_id]
+
+def create_agent(model_id):
+    """Create a Strands agent for model_id, one per request as agents must not be invoked concurrently"""
+    # No printing callback: streamed chunks of concurrent calls would interleave on stdout
+    return Agent(model=get_bedrock_model(model_id), callback_handler=None)
+
+async def request_purposes(batch):
+    """Get the purposes of a batch from Nova Micro, asking Nova Lite only for the methods it left unusable"""
+    uids = {method[0] for method in batch}
+    usable = {}
+    try:
+        response = await create_agent(FAST_MODEL_ID).structured_output_async(BatchedPurposes, render_prompt(batch))
+        purposes = {item.id: item.purpose for item in response.items if item.id in uids}
+        usable = {uid: p for uid, p in purposes.items() if not p.lower().startswith(GENERIC_PURPOSES)}
+        if len(usable) == len(uids):
+            return usable
+    except ValueError:
+        pass  # Output that fails schema validation or has no structured output is retried on Nova Lite as well
     
+    # Re-prompt Nova Lite with only the missing or generic methods
+    retry = [method for method in batch if method[0] not in usable]
     try:
-        response = agent(prompt)
-        return response.message if hasattr(response, 'message') else str(response)
-    except Exception as e:
-        return f"Analysis failed: {str(e)}"
+        response = await create_agent(FALLBACK_MODEL_ID).structured_output_async(BatchedPurposes, render_prompt(retry))
+    except Exception:
+        # Keep whatever Nova Micro answered well rather than failing the whole batch
+        if usable:
+            return usable
+        raise
+    lite = {item.id: item.purpose for item in response.items if item.id in uids}
+    return {**lite, **usable}
+
+def iter_batches(pending):
+    """Group pending (uid, ..., method_body) tuples into batches of bounded prompt size"""
+    # Count the instructions wrapped around the entries and each entry as rendered, joining newline included
+    overhead_chars = len(render_prompt([]))
+    batch, batch_chars = [], overhead_chars
+    for method in pending:
+        method_chars = len(render_method(*method)) + 1
+        # Close the batch before a method would take it over budget; an oversized method still goes alone
+        if batch and ((batch_chars + method_chars) // 4 > MAX_BATCH_TOKENS or len(batch) >= MAX_BATCH_METHODS):
+            yield batch
+            batch, batch_chars = [], overhead_chars
+        batch.append(method)
+        batch_chars += method_chars
+    if batch:
+        yield batch
 
 def main(repo_path):
-    # Initialize Bedrock model with Nova Lite using default credentials
-    bedrock_model = BedrockModel(
-        model_id="amazon.nova-lite-v1:0",
-        region_name="us-east-1"
-    )
-    
-    # Initialize Strands agent with Bedrock model
-    agent = Agent(model=bedrock_model)
+    # Build the Bedrock clients up front, their setup is paid once per process
+    for model_id in (FAST_MODEL_ID, FALLBACK_MODEL_ID):
+        get_bedrock_model(model_id)
     
     print(f"Analyzing repository: {repo_path}")
     
-    # Step 1: List files
-    files = list_files(repo_path)
-    print(f"Found {len(files)} Java files")
+    methods = []
+    total_files = 0
     
-    all_tests = []
-    
-    for file_path in files:
-        if not os.path.exists(file_path):
-            continue
-            
-        # Step 2: Find test lines
-        test_lines = find_test_lines(file_path)
+    # Step 1: List files, streaming each one into steps 2-3
+    for file_path in iter_files(repo_path):
+        total_files += 1
         
-        if not test_lines or test_lines == ['']:
+        # Map each file once; the scan and the body extraction below share it
+        try:
+            with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                ctx = FileCtx(file_path, mm)
+                
+                # Steps 2-3: Find test methods
+                test_methods = find_test_methods(ctx)
+                
+                if not test_methods:
+                    continue
+                    
+                print(f"\nProcessing {file_path} - found {len(test_methods)} test methods")
+                
+                # Read the bodies for step 4 while the file is still mapped
+                methods.extend((file_path, test_line.content, extract_method_body(ctx, test_line))
+                               for test_line in test_methods[:3])  # Limit to first 3 per file for demo
+        except (OSError, ValueError):  # ValueError: mmap cannot map empty files
             continue
-            
-        # Step 3: Extract test methods
-        test_methods = extract_test_methods(test_lines)
-        
-        if not test_methods:
-            continue
-            
-        print(f"\nProcessing {file_path} - found {len(test_methods)} test methods")
+    
+    print(f"Found {total_files} Java files")
+    
+    # Step 4: Analyze tests with AGENT, batching the methods of several files into each call
+    keys = [body_fingerprint(method_body) for _, _, method_body in methods]
+    
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    with shelve.open(CACHE_PATH) as cache:
+        # Reuse purposes of bodies analyzed before, only send the rest to the agent
+        purposes = [cache.get(key) for key in keys]
+        # Send one method per distinct body; the others with the same body reuse its answer
+        uids_by_key = {}
+        for uid, key in enumerate(keys):
+            if purposes[uid] is None:
+                uids_by_key.setdefault(key, []).append(uid)
+        pending = [(uids[0], methods[uids[0]][2]) for uids in uids_by_key.values()]
         
-        # Step 4: Analyze each test with AGENT
-        for method_line in test_methods[:3]:  # Limit to first 3 for demo
-            purpose = analyze_test_with_agent(method_line, file_path, agent)
-            all_tests.append({
-                'file': file_path,
-                'method': method_line,
-                'purpose': purpose
-            })
+        for answers, from_model in asyncio.run(analyze_batches(iter_batches(pending))):
+            for uid, purpose in answers.items():
+                for same_uid in uids_by_key[keys[uid]]:
+                    purposes[same_uid] = purpose
+                if from_model:
+                    cache[keys[uid]] = purpose
+    
+    all_tests = [
+        {
+            'file': file_path,
+            'method': method_content,
+            'purpose': purpose or "Unknown test"
+        }
+        for (file_path, method_content, _), purpose in zip(methods, purposes)
+    ]
     
     # Output results
     print(f"\n{'='*80}")
@@ -121,7 +311,7 @@ def main(repo_path):
     
     for test in all_tests:
         print(f"\nFile: {test['file']}")
-        print(f"Method: {test['method'].split(':', 1)[1].strip() if ':' in test['method'] else test['method']}")
+        print(f"Method: {test['method'].strip()}")
         print(f"Purpose: {test['purpose']}")
         print("-" * 50)
 
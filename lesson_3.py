@@ -141,6 +141,13 @@ def create_test_extraction_agent():
     
     return agent
 
+def get_response_text(result):
+    """Get the text of the agent's final message, without the rest of the message structure"""
+    try:
+        return "".join(block["text"] for block in result.message["content"] if "text" in block)
+    except (AttributeError, KeyError, TypeError) as e:
+        raise ValueError(f"Unexpected agent response format: {e}") from e
+
 def main():
     """Main interactive loop"""
     print("🤖 Test Extraction Agent - Powered by Amazon Nova Lite")
@@ -177,6 +184,7 @@ def main():
             
             try:
                 result = agent(prompt)
+                analysis = get_response_text(result)
                 print("\n" + "="*60)
                 print("ANALYSIS COMPLETE")
                 print("="*60)
@@ -184,7 +192,7 @@ def main():
                 # Save results to file
                 output_file = f"test_analysis_{repo_path.replace('/', '_').replace(' ', '_')}.txt"
                 with open(output_file, 'w') as f:
-                    f.write(str(result.message))
+                    f.write(analysis)
                 
                 print(f"📄 Results saved to: {output_file}")
                 
@@ -198,7 +206,7 @@ def main():
                 
             try:
                 result = agent(user_input)
-                print(f"\n🤖 Agent: {result.message}")
+                print(f"\n🤖 Agent: {get_response_text(result)}")
             except Exception as e:
                 print(f"❌ Error: {e}")
         